@@ -6,7 +6,7 @@ Training environment for deep hedging.
 June 30, 2022
 @author: hansbuehler
 """
-from .base import Logger, Config, tf, dh_dtype, pdct, tf_back_flatten, tf_make_dim, Int, Float, tfCast, create_optimizer, TF_VERSION
+from .base import Logger, Config, tf, dh_dtype, pdct, tf_back_flatten, tf_make_dim, Int, Float, tfCast, create_optimizer
 from .agents import AgentFactory
 from .objectives import MonetaryUtility
 from .softclip import DHSoftClip
@@ -16,12 +16,24 @@ import numpy as np
 
 _log = Logger(__file__)
 
+class _SignedCalls(object):
+    """
+    Plain container for the tf.functions which bind VanillaDeepHedgingGym._call() to a fixed input signature, one per value of 'training'.
+    This is deliberately not a dictionary: keras wraps dictionaries assigned to model attributes for tracking,
+    and such wrappers can neither be used as 'input_signature' nor be checkpointed with non-string keys.
+    """
+    def __init__(self, signature : dict ):
+        self.signature = signature  # nested dictionary of tf.TensorSpec's
+        self.functions = {}         # tf.function per value of 'training'
+
 class VanillaDeepHedgingGym(tf.keras.Model):
     """ 
     Vanilla periodic policy search Deep Hedging engine https://arxiv.org/abs/1802.03042 
     Vewrsion 2.0 supports recursive and iterative networks
     Hans Buehler, June 2022
     """
+
+    Live_Features = [ 'action', 'delta', 'cost', 'pnl' ]  # features computed by the gym while stepping through time
     
     def __init__(self, config : Config, name : str = "VanillaDeepHedging", dtype = dh_dtype ):
         """
@@ -47,18 +59,26 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         """
         tf.keras.Model.__init__(self, name=name, dtype=dtype )
         seed                       = config.tensorflow("seed", 423423423, int, "Set tensor random seed. Leave to None if not desired.")
-        self.softclip              = DHSoftClip( config.environment )
+        self.xla_inference         = config.tensorflow("jit_compile", False, bool, "Compile inference calls with XLA. This only applies to agents which are neither recurrent nor use live features: XLA cannot compute gradients through the iterative loop")
+        self.check_numerics        = config.debug("check_numerics", False, bool, "Whether to check numerics and bounds inside the gym. This slows down the main loop and turns off XLA compilation")
+        nInst                      = config.environment("n_instruments", None, help="Optional number of hedging instruments. If specified, the agent and the monetary utilities are created when the gym is constructed rather than on its first call")
+        self.softclip              = DHSoftClip( config.environment, check_numerics=self.check_numerics )
         self.config_agent          = config.agent.detach()
         self.config_objective      = config.objective.detach()
         self.user_version          = config("user_version", None, help="An arbitrary string which can be used to identify a particular gym. Changing this value will generate a new cache key")
         self.agent                 = None
         self.utility               = None
         self.utility0              = None
+        self.signed_calls          = None    # _SignedCalls with the input signature of call(), determined in build()
+        self.num_weights_cache     = None    # see num_trainable_weights
+        self.feature_layout        = None    # names and dimensions of features, determined in build()
         self.unique_id             = config.unique_id()  # for serialization
         config.done()
         
         if not seed is None:
             tf.random.set_seed( seed )
+        if not nInst is None:
+            self._create_agent( int(nInst) )
 
     # -------------------
     # keras model pattern
@@ -66,13 +86,29 @@ class VanillaDeepHedgingGym(tf.keras.Model):
             
     def build(self, shapes : dict ):
         """ Build the model. See call(). """
-        assert self.agent is None, "build() called twice?"
+        assert self.feature_layout is None, "build() called twice?"
         _log.verify( isinstance(shapes, Mapping), "'shapes' must be a dictionary type. Found type %s", type(shapes ))
 
-        nInst         = int( shapes['market']['hedges'][2] )
-        self.agent    = AgentFactory( nInst, self.config_agent, name="agent",    dtype=self.dtype ) 
-        self.utility  = MonetaryUtility( self.config_objective, name="utility",  dtype=self.dtype ) 
-        self.utility0 = MonetaryUtility( self.config_objective, name="utility0", dtype=self.dtype ) 
+        # geometry
+        # shape validation happens here, once, rather than in _call()
+        # call() validates data which does not match the input signature determined below
+        _, nInst, self.feature_layout = self._verify_shapes( shapes )
+
+        nInst         = int( nInst )
+        if self.agent is None:
+            self._create_agent( nInst )
+        else:
+            _log.verify( self.agent.nInst == nInst, "Gym was constructed for %ld instruments (see config.gym.environment.n_instruments), but data has %ld instruments", self.agent.nInst, nInst )
+        self.num_weights_cache = None
+
+        # fix the input signature with an arbitrary batch size
+        # this avoids retracing _call() for each new batch size, e.g. for the last batch of an epoch
+        self.signed_calls   = _SignedCalls( self._tensor_spec( shapes ) )
+
+        # warm up: trace _call() now for both training and inference
+        # such that the first batches only pay for execution
+        for training in [True, False]:
+            self._signed_call( training ).get_concrete_function()
 
     def call( self, data : dict, training : bool = False ) -> dict:
         """
@@ -111,8 +147,14 @@ class VanillaDeepHedgingGym(tf.keras.Model):
                 actions:         (,M,N) actions, per step, per path
                 deltas:          (,M,N) deltas, per step, per path
         """
-        return self._call( tfCast(data), training )
-    @tf.function  
+        data = tfCast(data)
+        self._verify_batch_size( data )
+        if isinstance(training, bool) and self._matches_signature( data ):
+            return self._signed_call( training )( data )
+        self._verify_data( data )
+        return self._call( data, training )
+
+    @tf.function
     def _call( self, data : dict, training : bool ) -> dict:
         """ The _call function was introduced to allow conversion of numpy arrays into tensors ahead of tf.function tracing """
         _log.verify( isinstance(data, Mapping), "'data' must be a dictionary type. Found type %s", type(data ))
@@ -120,9 +162,9 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         
         # geometry
         # --------
+        # shapes were validated in build()
         hedges       = data['market']['hedges']
         hedge_shape  = hedges.shape.as_list()
-        _log.verify( len(hedge_shape) == 3, "data['market']['hedges']: expected tensor of dimension 3. Found shape %s", hedge_shape )
         nBatch       = hedge_shape[0]    # is None at first call. Later will be batch size
         nSteps       = hedge_shape[1]
         nInst        = hedge_shape[2]
@@ -133,16 +175,12 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         ubnd_a       = data['market']['ubnd_a']
         lbnd_a       = data['market']['lbnd_a']
         payoff       = data['market']['payoff']
-        payoff       = payoff[:,0] if payoff.shape.as_list() == [nBatch,1] else payoff # handle tf<=2.6        
-        _log.verify( trading_cost.shape.as_list() == [nBatch, nSteps, nInst], "data['market']['cost']: expected shape %s, found %s", [nBatch, nSteps, nInst], trading_cost.shape.as_list() )
-        _log.verify( ubnd_a.shape.as_list() == [nBatch, nSteps, nInst], "data['market']['ubnd_a']: expected shape %s, found %s", [nBatch, nSteps, nInst], ubnd_a.shape.as_list() )
-        _log.verify( lbnd_a.shape.as_list() == [nBatch, nSteps, nInst], "data['market']['lbnd_a']: expected shape %s, found %s", [nBatch, nSteps, nInst], lbnd_a.shape.as_list() )
-        _log.verify( payoff.shape.as_list() == [nBatch], "data['market']['payoff']: expected shape %s, found %s", [nBatch], payoff.shape.as_list() )
+        payoff       = tf.squeeze( payoff, axis=1 ) if payoff.shape.rank == 2 else payoff   # handle tf<=2.6
         
         # features
         # --------
         features_per_step, \
-        features_per_path = self._features( data, nSteps )
+        features_per_path = self._features_slice( data )
             
         # main loop
         # ---------
@@ -151,6 +189,8 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         # - an initial delta add-on which uses a different network than the agent for every time step.
         #   the reason is that if the payoff is unhedged, initial delta is very different than subsequent actions
         # - Tensorflow compilable loop, e.g. the loop below will not be unrolled when tensorflow compiles the function
+        # - optional XLA compilation for inference, see config.gym.tensorflow.jit_compile
+        # - a vectorized mode for agents which neither are recurrent nor use any of 'Live_Features'
 
         # meaningful features at first time step
         features_time_0 = {}
@@ -162,40 +202,83 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         cost    = tf.zeros_like(payoff, dtype=dh_dtype)                                                       # [?,]
         delta   = tf.zeros_like(trading_cost[:,0,:], dtype=dh_dtype)                                          # [?,nInst]
         action  = tf.zeros_like(trading_cost[:,0,:], dtype=dh_dtype)                                          # [?,nInst]
-        actions = tf.zeros_like(trading_cost[:,0,:][:,tf.newaxis,:], dtype=dh_dtype)                          # [?,0,nInst]
         state   = self.agent.initial_state( features_time_0, training=training ) if self.agent.is_recurrent else tf.zeros_like(pnl, dtype=dh_dtype)  # [?,nStates] if states are used else [?]
         idelta  = self.agent.initial_delta( features_time_0, training=training ) if self.agent.has_initial_delta else tf.zeros_like(delta, dtype=dh_dtype)  # [?,nInst] 
+        lbnd_o, \
+        ubnd_o  = self.softclip.outer_bounds( lbnd_a, ubnd_a )                                                  # [?,nSteps,nInst] or None
+        market  = tf.stack( [ trading_cost, hedges ], axis=-1, name="market" )                                  # [?,nSteps,nInst,2] for cost and pnl
         
-        t       = 0
-        while tf.less(t,nSteps, name="main_loop"): # logically equivalent to: for t in range(nSteps):
-            tf.autograph.experimental.set_loop_options( shape_invariants=[(actions, tf.TensorShape([None,None,nInst]))] )
-            
-            # 1: build features, including recurrent state
-            live_features = dict( action=action, delta=delta, cost=cost, pnl=pnl )
-            live_features.update( { f:features_per_path[f] for f in features_per_path } )
-            live_features.update( { f:features_per_step[f][:,t,:] for f in features_per_step})
-            if self.agent.is_recurrent: live_features[ self.agent.state_feature_name ] = state
-
-            # 2: action
-            action, state_ =  self.agent( live_features, training=training )
-            _log.verify( action.shape.as_list() == [nBatch, nInst], "Error: action return by agent: expected shape %s, found %s", [nBatch, nInst], action.shape.as_list() )
-            action         += idelta
-            action         =  self.softclip(action, lbnd_a[:,t,:], ubnd_a[:,t,:] )
-            state          =  state_ if self.agent.is_recurrent else state
-            delta          += action
-
-            # 3: trade
-            cost           += tf.reduce_sum( tf.math.abs( action ) * trading_cost[:,t,:], axis=1, name="cost_t" )
-            pnl            += tf.reduce_sum( action * hedges[:,t,:], axis=1, name="pnl_t" )
-
-            # 4: record actions per path, per step, continue loop
-            action_        =  tf.stop_gradient( action )[:,tf.newaxis,:]
-            actions        =  tf.concat( [actions,action_], axis=1, name="actions") if t>0 else action_
-            idelta         *= 0. # no more initial delta
-            t              += 1  # loop
-
-        pnl  = tf.debugging.check_numerics(pnl, "Numerical error computing pnl in %s. Turn on tf.enable_check_numerics to find the root cause. Note that they are disabled by default in trainer.py" % __file__ )
-        cost = tf.debugging.check_numerics(cost, "Numerical error computing cost in %s. Turn on tf.enable_check_numerics to find the root cause. Note that they are disabled by default in trainer.py" % __file__ )
+        if self.is_vectorized:
+            # vectorized mode
+            # if the agent is not recurrent and does not use any live features, then its actions
+            # do not depend on past actions. In this case we call the agent once for all steps.
+            nSamples      = tf.shape(payoff)[0]
+            flat_zeros    = tf.zeros_like( tf.reshape( trading_cost, [-1,nInst] ), dtype=dh_dtype )         # [?*nSteps,nInst]
+            step_features = dict( action=flat_zeros, delta=flat_zeros, cost=flat_zeros[:,0], pnl=flat_zeros[:,0] )
+            step_features.update( { f:tf.reshape( tf.broadcast_to( features_per_path[f][:,tf.newaxis,:], [nSamples,nSteps,features_per_path[f].shape[1]] ), [-1,features_per_path[f].shape[1]] ) for f in features_per_path } )
+            step_features.update( { f:tf.reshape( features_per_step[f], [-1,features_per_step[f].shape[2]] ) for f in features_per_step } )
+
+            actions, _     = self.agent( step_features, training=training )
+            _log.verify( actions.shape.as_list()[1:] == [nInst], "Error: action return by agent: expected shape %s, found %s", [None, nInst], actions.shape.as_list() )
+            actions        = tf.reshape( actions, [-1,nSteps,nInst] )                                         # [?,nSteps,nInst]
+            actions        += idelta[:,tf.newaxis,:] * tf.one_hot( 0, nSteps, dtype=dh_dtype )[tf.newaxis,:,tf.newaxis]
+            actions        =  self.softclip(actions, lbnd_a, ubnd_a, lbnd_o, ubnd_o )
+
+        else:
+            # iterative mode
+            actions       = tf.TensorArray(dh_dtype, size=nSteps, element_shape=tf.TensorShape([None,nInst]), clear_after_read=False, name="actions")  # nSteps x [?,nInst]
+            # running cost and pnl are only accumulated if the agent uses them as features
+            live_cost_pnl = 'cost' in self.agent.features or 'pnl' in self.agent.features
+
+            # per-step features used by the agent are concatenated once, so that each step requires only one slice
+            # the remaining per-step features are only passed so the agent reports them as available; it never reads them, hence their slices are pruned from the graph
+            step_names    = [ f for f, _ in self.feature_layout['per_step'] if f in self.agent.features ]
+            step_dims     = [ m for f, m in self.feature_layout['per_step'] if f in self.agent.features ]
+            step_unused   = [ f for f, _ in self.feature_layout['per_step'] if not f in self.agent.features ]
+            all_per_step  = tf.concat( [ features_per_step[f] for f in step_names ], axis=2, name="all_per_step" ) if len(step_names) > 0 else None  # [?,nSteps,sum(step_dims)]
+
+            # when training, recurrent states are kept in a fixed-size TensorArray; entry t is the state before step t
+            # for inference the state is simply overwritten at each step, so memory does not grow with the number of steps
+            keep_states   = self.agent.is_recurrent and isinstance(training, bool) and training
+            states        = tf.TensorArray(dh_dtype, size=nSteps+1, element_shape=tf.TensorShape([None,self.agent.nStates]), clear_after_read=False, name="states").write(0, state) if keep_states else state
+
+            for t in tf.range(nSteps, name="main_loop"): # bounded loop with known trip count
+                # 1: build features, including recurrent state
+                live_features = dict( features_per_path, action=action, delta=delta, cost=cost, pnl=pnl )
+                live_features.update( { f:features_per_step[f][:,t,:] for f in step_unused } )
+                if not all_per_step is None: live_features.update( zip( step_names, tf.split( all_per_step[:,t,:], step_dims, axis=1 ) ) )
+                if self.agent.is_recurrent: live_features[ self.agent.state_feature_name ] = states.read(t) if keep_states else states
+
+                # 2: action
+                action, state_ =  self.agent( live_features, training=training )
+                _log.verify( action.shape.as_list() == [nBatch, nInst], "Error: action return by agent: expected shape %s, found %s", [nBatch, nInst], action.shape.as_list() )
+                action         += idelta
+                action         =  self.softclip(action, lbnd_a[:,t,:], ubnd_a[:,t,:], lbnd_o[:,t,:] if not lbnd_o is None else None, ubnd_o[:,t,:] if not ubnd_o is None else None )
+                states         =  states.write( t+1, state_ ) if keep_states else ( state_ if self.agent.is_recurrent else states )
+                delta          += action
+
+                # 3: trade
+                if live_cost_pnl:
+                    cost_pnl_t     =  tf.reduce_sum( tf.stack( [ tf.math.abs( action ), action ], axis=-1 ) * market[:,t,:,:], axis=1, name="cost_pnl_t" )  # [?,2]
+                    cost           += cost_pnl_t[:,0]
+                    pnl            += cost_pnl_t[:,1]
+
+                # 4: record actions per path, per step, continue loop
+                actions        =  actions.write( t, action )
+                idelta         *= 0. # no more initial delta
+
+            actions = tf.transpose( actions.stack(), [1,0,2], name="actions" )                                   # [?,nSteps,nInst]
+
+        # cost and pnl
+        # total cost and pnl are computed in one reduction over the full horizon
+        cost_pnl = tf.einsum( 'btnk,btnk->bk', tf.stack( [ tf.math.abs( actions ), actions ], axis=-1 ), market, name="cost_pnl" )  # [?,2]
+        cost     = cost_pnl[:,0]                                                                               # [?,]
+        pnl      = cost_pnl[:,1]                                                                               # [?,]
+        actions  = tf.stop_gradient( actions )                                                                # [?,nSteps,nInst]
+
+        if self.check_numerics:
+            pnl  = tf.debugging.check_numerics(pnl, "Numerical error computing pnl in %s. Turn on tf.enable_check_numerics to find the root cause. This check is enabled by config.gym.debug.check_numerics" % __file__ )
+            cost = tf.debugging.check_numerics(cost, "Numerical error computing cost in %s. Turn on tf.enable_check_numerics to find the root cause. This check is enabled by config.gym.debug.check_numerics" % __file__ )
 
         # compute utility
         # ---------------
@@ -211,67 +294,185 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         # prepare output
         # --------------
             
+        analytics = tf.nest.map_structure( tf.stop_gradient, dict(
+            utility  = utility,                                   # [?,]
+            utility0 = utility0,                                  # [?,]
+            gains    = payoff + pnl - cost,                       # [?,]
+            payoff   = payoff,                                    # [?,]
+            pnl      = pnl,                                       # [?,]
+            cost     = cost,                                      # [?,]
+            ) )
         return pdct(
             loss     = -utility-utility0,                         # [?,]
-            utility  = tf.stop_gradient( utility ),               # [?,]
-            utility0 = tf.stop_gradient( utility0 ),              # [?,]
-            gains    = tf.stop_gradient( payoff + pnl - cost ),   # [?,]
-            payoff   = tf.stop_gradient( payoff ),                # [?,]
-            pnl      = tf.stop_gradient( pnl ),                   # [?,]
-            cost     = tf.stop_gradient( cost ),                  # [?,]
-            actions  = tf.concat( actions, axis=1, name="actions" ) # [?,nSteps,nInst]
+            **analytics,
+            actions  = actions                                    # [?,nSteps,nInst] (gradients already stopped)
         )
     
     # -------------------
     # internal
     # -------------------
 
+    def _create_agent( self, nInst : int ):
+        """ Create agent and monetary utilities for 'nInst' instruments. Called from build(), or from __init__() if the number of instruments was specified """
+        assert self.agent is None, "_create_agent() called twice?"
+        self.agent    = AgentFactory( nInst, self.config_agent, name="agent",    dtype=self.dtype ) 
+        self.utility  = MonetaryUtility( self.config_objective, name="utility",  dtype=self.dtype ) 
+        self.utility0 = MonetaryUtility( self.config_objective, name="utility0", dtype=self.dtype ) 
+
+    def _verify_shapes( self, shapes : dict ) -> (int, int, dict):
+        """
+        Validate the shapes of the market data and of all features.
+        Returns nSteps, nInst, and the feature layout, c.f. _features_static()
+        """
+        _log.verify( isinstance(shapes, Mapping), "'data' must be a dictionary type. Found type %s", type(shapes ))
+        hedge_shape   = tf.TensorShape( shapes['market']['hedges'] ).as_list()
+        _log.verify( len(hedge_shape) == 3, "data['market']['hedges']: expected tensor of dimension 3. Found shape %s", hedge_shape )
+        nSteps        = hedge_shape[1]
+        nInst         = hedge_shape[2]
+        for name in ['cost', 'ubnd_a', 'lbnd_a']:
+            shape = tf.TensorShape( shapes['market'][name] ).as_list()
+            _log.verify( shape[1:] == [nSteps, nInst], "data['market']['%s']: expected shape %s, found %s", name, [None, nSteps, nInst], shape )
+        payoff_shape  = tf.TensorShape( shapes['market']['payoff'] ).as_list()
+        _log.verify( len(payoff_shape) == 1 or payoff_shape[1:] == [1], "data['market']['payoff']: expected shape %s, found %s", [None], payoff_shape )
+        return nSteps, nInst, self._features_static( shapes, nSteps )
+
+    def _verify_data( self, data : dict ):
+        """
+        Validate 'data' which does not match the input signature determined in build(), for example because it has a different number of steps.
+        The data must provide all features used when the gym was built, with the same dimensions, and the same number of instruments.
+        """
+        _log.verify( not self.feature_layout is None, "build() must be called first")
+        _log.verify( isinstance(data, Mapping), "'data' must be a dictionary type. Found type %s", type(data ))
+        _, nInst, layout = self._verify_shapes( tf.nest.map_structure( lambda x : x.shape, data ) )
+        _log.verify( nInst == self.agent.nInst, "data['market']['hedges']: gym was built for %ld instruments, found %s", self.agent.nInst, nInst )
+        for section in ['per_step', 'per_path']:
+            dims = dict( layout[section] )
+            for f, m in self.feature_layout[section]:
+                _log.verify( f in dims, "data['features']['%s']: feature '%s' was present when the gym was built, but is missing. Found features: %s", section, f, list(dims) )
+                _log.verify( dims[f] == m, "data['features']['%s']['%s']: gym was built for dimension %ld, found %ld", section, f, m, dims[f] )
+
+    def _verify_batch_size( self, data : dict ):
+        """
+        Validate that all members of 'data' have the same number of samples as data['market']['hedges'].
+        This is a static check: it is skipped for tensors whose first dimension is not known.
+        The input signature determined in build() does not enforce this as each member has its own arbitrary batch size.
+        """
+        _log.verify( isinstance(data, Mapping), "'data' must be a dictionary type. Found type %s", type(data ))
+        nBatch = data['market']['hedges'].shape[0]
+        if nBatch is None:
+            return
+        for x in tf.nest.flatten( data ):
+            shape = x.shape.as_list()
+            _log.verify( len(shape) > 0 and shape[0] in [None, nBatch], "data: all members must have the same number of samples as data['market']['hedges'], %ld. Found member of shape %s", nBatch, shape )
+
+    def _tensor_spec( self, shapes ):
+        """ Returns a nested dictionary of tf.TensorSpec's matching 'shapes', with arbitrary batch size """
+        if isinstance(shapes, Mapping):
+            return { k : self._tensor_spec( shapes[k] ) for k in shapes }
+        shape = tf.TensorShape( shapes )
+        shape = [None] + shape.as_list()[1:] if not shape.rank is None and shape.rank > 0 else shape
+        return tf.TensorSpec( shape, dtype=self.dtype )
+
+    def _matches_signature( self, data : dict ) -> bool:
+        """ Whether 'data' is compatible with the input signature determined in build() """
+        if self.signed_calls is None:
+            return False
+        signature = self.signed_calls.signature
+        try:
+            tf.nest.assert_same_structure( signature, data )
+        except (ValueError, TypeError):
+            return False
+        return all( spec.is_compatible_with( tensor ) for spec, tensor in zip( tf.nest.flatten( signature ), tf.nest.flatten( data ) ) )
+
+    def _use_xla( self, training : bool ) -> bool:
+        """
+        Whether to compile _call() with XLA for the given value of 'training'.
+        XLA cannot compute gradients through the TensorArray's of the iterative loop; hence it is only used for inference of vectorized agents.
+        XLA also drops tf.debugging assertions, hence it is not used if 'check_numerics' is on.
+        """
+        return self.xla_inference and not training and self.is_vectorized and not self.check_numerics
+
+    def _signed_call( self, training : bool ):
+        """ Returns _call() as a tf.function with fixed input signature for the given value of 'training'. """
+        signed_call = self.signed_calls.functions.get( training, None )
+        if signed_call is None:
+            def call_training( data ):
+                return self._call( data, training )
+            signed_call = tf.function( call_training, input_signature=[self.signed_calls.signature], jit_compile=self._use_xla( training ) )
+            self.signed_calls.functions[training] = signed_call
+        return signed_call
+
     @staticmethod
-    def _features( data : dict, nSteps : int = None ) -> (dict, dict):
+    def _features_static( shapes : dict, nSteps : int = None ) -> dict:
         """ 
-        Collect requested features and convert them into common shapes.   
+        Validate the shapes of all features, and determine their names and dimensions.
         
         Parameters
         ----------
-            data: essentially world.tf_data
+            shapes: shapes of world.tf_data, as passed to build()
             nSteps: for validation. Can be left None to ignore.
         
         Returns
         -------
-            features_per_step, features_per_path : (dict, dict)
-                features_per_step: requested features which are available per step. Each feature has dimension [nSamples,nSteps,M] for some M
-                features_per_path: requested features with dimensions [nSamples,M]
+            Feature layout: dict with entries 'per_step' and 'per_path'.
+            Each is a list of ( name, M ) where M is the dimension of the feature after flattening, c.f. _features_slice()
         """
-        features             = data.get('features',{})
+        features             = shapes.get('features',{})
 
         features_per_step_i  = features.get('per_step', {})
-        features_per_step    = {}
+        features_per_step    = []
         for f in features_per_step_i:
-            feature = features_per_step_i[f]
-            assert isinstance(feature, tf.Tensor), "Internal error: type %s found" % feature.__class__.__name__
-            _log.verify( len(feature.shape) >= 2, "data['features']['per_step']['%s']: expected tensor of at least dimension 2, found shape %s", f, feature.shape.as_list() )
-            if not nSteps is None: _log.verify( feature.shape[1] == nSteps, "data['features']['per_step']['%s']: second dimension must match number of steps, %ld, found shape %s", f, nSteps, feature.shape.as_list() )
-            features_per_step[f] = tf_make_dim( feature, 3 )
-
-        features_per_path_i    = features.get('per_path', {})
-        features_per_path      = {}
-        assert isinstance( features_per_path_i, dict), "Internal error: type %s found" % features_per_path_i.__class__.__name__
+            shape = tf.TensorShape( features_per_step_i[f] ).as_list()
+            _log.verify( len(shape) >= 2, "data['features']['per_step']['%s']: expected tensor of at least dimension 2, found shape %s", f, shape )
+            if not nSteps is None: _log.verify( shape[1] == nSteps, "data['features']['per_step']['%s']: second dimension must match number of steps, %ld, found shape %s", f, nSteps, shape )
+            features_per_step.append( ( f, int( np.prod( shape[2:] ) ) ) )
+
+        features_per_path_i  = features.get('per_path', {})
+        features_per_path    = []
+        _log.verify( isinstance( features_per_path_i, Mapping), "data['features']['per_path'] must be a dictionary type. Found type %s", type(features_per_path_i) )
         for f in features_per_path_i:
-            feature = features_per_path_i[f]
-            assert isinstance(feature, tf.Tensor), "Internal error: type %s found" % feature.__class__.__name__
-            features_per_path[f] = tf_make_dim( feature, dim=2 ) 
+            shape = tf.TensorShape( features_per_path_i[f] ).as_list()
+            _log.verify( len(shape) >= 1, "data['features']['per_path']['%s']: expected tensor of at least dimension 1, found shape %s", f, shape )
+            features_per_path.append( ( f, int( np.prod( shape[1:] ) ) ) )
+        return dict( per_step=features_per_step, per_path=features_per_path )
+
+    def _features_slice( self, data : dict ) -> (dict, dict):
+        """ 
+        Collect features and convert them into common shapes.
+        Shapes are not validated; this is done once in build(). See _features_static()
+        
+        Parameters
+        ----------
+            data: essentially world.tf_data
+        
+        Returns
+        -------
+            features_per_step, features_per_path : (dict, dict)
+                features_per_step: requested features which are available per step. Each feature has dimension [nSamples,nSteps,M] for some M
+                features_per_path: requested features with dimensions [nSamples,M]
+        """
+        features          = data.get('features',{})
+        features_per_step = { f: tf_make_dim( features['per_step'][f], dim=3 ) for f, _ in self.feature_layout['per_step'] }
+        features_per_path = { f: tf_make_dim( features['per_path'][f], dim=2 ) for f, _ in self.feature_layout['per_path'] }
         return features_per_step, features_per_path
 
     # -------------------
     # syntatic sugar
     # -------------------
 
+    @property
+    def is_vectorized(self) -> bool:
+        """ Whether the agent is neither recurrent nor uses any of 'Live_Features', such that all its actions can be computed in one call. The model must have been call()ed once """
+        _log.verify( not self.agent is None, "Cannot call this function before model was built")
+        return not self.agent.is_recurrent and not any( f in self.agent.features for f in self.Live_Features )
+
     @property
     def num_trainable_weights(self) -> int:
         """ Returns the number of weights. The model must have been call()ed once """
-        assert not self.agent is None, "build() must be called first"
-        weights = self.trainable_weights
-        return np.sum( [ np.prod( w.get_shape() ) for w in weights ] )
+        assert not self.feature_layout is None, "build() must be called first"
+        if self.num_weights_cache is None:
+            self.num_weights_cache = int( sum( int( np.prod( w.shape ) ) for w in self.trainable_weights ) )
+        return self.num_weights_cache
     
     @property
     def available_features_per_step(self) -> list:
@@ -301,35 +502,28 @@ class VanillaDeepHedgingGym(tf.keras.Model):
     # caching
     # -------------------
     
-    def create_cache( self ):
+    def create_cache( self, checkpoint_prefix : str ):
         """
         Create a dictionary which allows reconstructing the current model.
         The content of the dictionary are IDs to validate that we are reconstructing the same type of gym,
-        weights of the gym and the optimizer, and the last learning rate of the optimizer.
-        
-        Note: reconstruction of an optimizer state is not natively supported in TensorFlow. Below might not work perfectly.
+        and the prefix of a tf.train.Checkpoint of the gym and its optimizer, including the last learning rate of the optimizer.
+        The checkpoint is written to 'checkpoint_prefix', typically next to the file the dictionary is written to.
         """
-        assert not self.agent is None, "build() not called yet"
-        opt_weights = self.optimizer.get_weights() if not getattr(self.optimizer,"get_weights",None) is None else None
+        assert not self.feature_layout is None, "build() not called yet"
         opt_config  = tf.keras.optimizers.serialize( self.optimizer )['config'] if not self.optimizer is None else None
         
-        if not opt_config is None and opt_weights is None:
-            # tensorflow 2.11 abandons 'get_weights'
-            variables   = self.optimizer.variables()        
-            opt_weights = [ np.array( v ) for v in variables ]
-        
         # we compute a config ID for all parameters but the learning rate
         # That should work for most optimizers, but future optimizers may
         # rquire copying furhter variables
         id_config   = { k: opt_config[k] for k in opt_config if k != 'learning_rate' } if not opt_config is None else None
         opt_uid     = uniqueHash( id_config ) if not id_config is None else ""
-        opt_weights = self.optimizer.get_weights() if TF_VERSION <= 210 else [ w.value() for w in self.optimizer.variables() ]
+        
+        checkpoint  = self._cache_checkpoint().write( checkpoint_prefix )
         
         return dict( gym_uid       = self.unique_id,
-                     gym_weights   = self.get_weights(),
                      opt_uid       = opt_uid,
                      opt_config    = opt_config,
-                     opt_weights   = opt_weights
+                     checkpoint    = checkpoint
                    )
                 
     def restore_from_cache( self, cache ) -> bool:
@@ -337,15 +531,12 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         Restore 'self' from cache.
         Note that we have to call() this object before being able to use this function        
         This function returns False if the cached weights do not match the current architecture.
-        
-        Note: reconstruction of an optimizer state is not natively supported in TensorFlow. Below might not work perfectly.
+        Caches written by earlier versions contain 'gym_weights' and 'opt_weights' instead of a 'checkpoint'; those are still supported.
         """        
-        assert not self.agent is None, "build() not called yet"
+        assert not self.feature_layout is None, "build() not called yet"
         gym_uid     = cache['gym_uid']
-        gym_weights = cache['gym_weights']
         opt_uid     = cache['opt_uid']
         opt_config  = cache['opt_config']
-        opt_weights = cache['opt_weights']
         
         self_opt_config = tf.keras.optimizers.serialize( self.optimizer )['config'] if not self.optimizer is None else None
         self_id_config  = { k: opt_config[k] for k in opt_config if k != 'learning_rate' } if not self_opt_config is None else None
@@ -360,6 +551,28 @@ class VanillaDeepHedgingGym(tf.keras.Model):
                        "Stored configuration: %s\nCurrent configuration: %s", opt_uid, self_opt_uid, opt_config, self_opt_config)
             return False
 
+        if not 'checkpoint' in cache:
+            return self._restore_from_legacy_cache( cache )
+
+        # restore checkpoint
+        # Optimizer variables which do not exist yet are restored when they are created
+        try:
+            self._cache_checkpoint().read( cache['checkpoint'] ).assert_existing_objects_matched().expect_partial()
+        except (ValueError, AssertionError, tf.errors.OpError) as v:
+            _log.warn( "Cache restoration error: could not restore checkpoint '%s'.\n%s", cache['checkpoint'], v)
+            return False
+        return True
+
+    def _cache_checkpoint( self ) -> tf.train.Checkpoint:
+        """ Returns a checkpoint of 'self' and its optimizer, if any """
+        return tf.train.Checkpoint( model=self ) if self.optimizer is None else tf.train.Checkpoint( model=self, optimizer=self.optimizer )
+
+    def _restore_from_legacy_cache( self, cache ) -> bool:
+        """ Restore 'self' from a cache created by a version which stored weights rather than a checkpoint. See restore_from_cache() """
+        gym_weights = cache['gym_weights']
+        opt_config  = cache['opt_config']
+        opt_weights = cache['opt_weights']
+
         # load weights
         # Note that we will continue with the restored weights for the gym even if we fail to restore the optimizer
         # This is likely the desired behaviour.
@@ -368,7 +581,6 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         except ValueError as v:
             _log.warn( "Cache restoration error: provided cache gym weights were not compatible with the gym.\n%s", v)
             return False
-        return True
     
         if self.optimizer is None:
             return True    
@@ -376,14 +588,21 @@ class VanillaDeepHedgingGym(tf.keras.Model):
         if 'learning_rate' in opt_config:
             self.optimizer.learning_rate = opt_config['learning_rate']
         # restore weights
+        # tensorflow 2.11 optimizers create their variables lazily and retired set_weights()
         try:
-            self.optimizer.set_weights( opt_weights )
+            if not getattr(self.optimizer,"set_weights",None) is None:
+                self.optimizer.set_weights( opt_weights )
+            else:
+                self.optimizer.build( self.trainable_variables )
+                variables = self.optimizer.variables() if callable( self.optimizer.variables ) else self.optimizer.variables
+                if len(variables) != len(opt_weights):
+                    raise ValueError("Cached optimizer has %ld variables, but current optimizer has %ld" % ( len(opt_weights), len(variables) ))
+                for variable, weight in zip( variables, opt_weights ):
+                    variable.assign( weight )
         except ValueError as v:
             isTF211 = getattr(self.optimizer,"get_weights",None) is None
             isTF211 = "" if not isTF211 else "Code is running TensorFlow 2.11 or higher for which tf.keras.optimizers.Optimizer.get_weights() was retired. Current code is experimental. Review create_cache/restore_from_cache.\n"
-            _log.warn( "Cache restoration error: cached optimizer weights were not compatible with existing optimizer.\n%s%s", v)
+            _log.warn( "Cache restoration error: cached optimizer weights were not compatible with existing optimizer.\n%s%s", isTF211, v)
             return False
-
-        
         return True
 
@@ -57,11 +57,7 @@ class VariableLayer(tf.keras.layers.Layer):
         """
         dummy = dummy_data[DIM_DUMMY]
         assert len(dummy.shape) == 2, "Internal error: shape %s not (None,)" % str(dummy.shape.as_list())
-        x     = tf.zeros_like(dummy[:,0])
-        while len(x.shape) <= len(self.variable.shape):
-            x = x[:,tf.newaxis,...]
-        x = x + self.variable[tf.newaxis,...]
-        return x
+        return tf.broadcast_to( self.variable[tf.newaxis,...], [ tf.shape(dummy)[0] ] + self.variable.shape.as_list() )
     
     @property
     def features(self) -> list:
@@ -22,48 +22,66 @@ class DHSoftClip(tf.keras.layers.Layer):
     TODO: remove dependency on tensorflow_probability
     """
 
-    def __init__(self, config, name : str = None, dtype : tf.DType = dh_dtype ):
+    def __init__(self, config, name : str = None, dtype : tf.DType = dh_dtype, check_numerics : bool = False ):
         """
         Initialize softclip from tensorflow_probability
+        If 'check_numerics' is True, then bounds and actions are validated numerically on each call
         """
         tf.keras.layers.Layer.__init__(self, name=name, dtype=dtype )        
     
-        self.hard_clip             = config('hard_clip', False, bool, "Use min/max instread of soft clip for limiting actions by their bounds")
+        self.hard_clip             = config('hard_clip', False, bool, "Use min/max instread of soft clip for limiting actions by their bounds. This is faster but leads to zero gradients outside the bounds")
         self.outer_clip            = config('outer_clip', True, bool, "Apply a hard clip 'outer_clip_cut_off' times the boundaries")
         self.outer_clip_cut_off    = config('outer_clip_cut_off', 10., Float>=1., "Multiplier on bounds for outer_clip")
         hinge_softness             = config('softclip_hinge_softness', 1., Float>0., "Specifies softness of bounding actions between lbnd_a and ubnd_a")
         self.softclip              = tfp.bijectors.SoftClip( low=0., high=1., hinge_softness=hinge_softness, name='soft_clip' if name is None else name )
+        self.check_numerics        = bool(check_numerics)
         config.done()
     
-    def __call__( self, actions, lbnd_a, ubnd_a ):
-        """ Clip the action within lbnd_a, ubnd_a """
+    def outer_bounds( self, lbnd_a, ubnd_a ):
+        """ Returns the bounds used for 'outer_clip', or (None, None) if not applicable. Use this to compute outer bounds once for all time steps """
+        if self.hard_clip or not self.outer_clip:
+            return None, None
+        return lbnd_a*self.outer_clip_cut_off, ubnd_a*self.outer_clip_cut_off
+
+    def __call__( self, actions, lbnd_a, ubnd_a, lbnd_outer = None, ubnd_outer = None ):
+        """ Clip the action within lbnd_a, ubnd_a. 'lbnd_outer' and 'ubnd_outer' are computed with outer_bounds() if not provided """
+        if not self.check_numerics:
+            return self._clip( actions, lbnd_a, ubnd_a, lbnd_outer, ubnd_outer )
         
         with tf.control_dependencies( [ tf.debugging.assert_greater_equal( ubnd_a, lbnd_a, message="Upper bound for actions must be bigger than lower bound" ),
                                         tf.debugging.assert_greater_equal( ubnd_a, 0., message="Upper bound for actions must not be negative" ),
                                         tf.debugging.assert_less_equal( lbnd_a, 0., message="Lower bound for actions must not be positive" ) ] ):
-        
-            if self.hard_clip:
-                # hard clip
-                # this is recommended for debugging only.
-                # soft clipping should lead to smoother gradients
-                actions = tf.minimum( actions, ubnd_a, name="hard_clip_min" )
-                actions = tf.maximum( actions, lbnd_a, name="hard_clip_max" )
-                return actions            
+            return self._clip( actions, lbnd_a, ubnd_a, lbnd_outer, ubnd_outer )
+
+    def _clip( self, actions, lbnd_a, ubnd_a, lbnd_outer, ubnd_outer ):
+        """ Clip the action within lbnd_a, ubnd_a. See __call__ """
+        if self.hard_clip:
+            # hard clip
+            # this is recommended for debugging only.
+            # soft clipping should lead to smoother gradients
+            return tf.clip_by_value( actions, lbnd_a, ubnd_a, name="hard_clip" )
 
-            if self.outer_clip:
-                # to avoid very numerical errors due to very
-                # large pre-clip actions, we cap pre-clip values
-                # hard at 10 times the bounds.
-                # This can happen if an action has no effect
-                # on the gains process (e.g. hedge == 0)
-                actions = tf.minimum( actions, ubnd_a*self.outer_clip_cut_off, name="outer_clip_min" )
-                actions = tf.maximum( actions, lbnd_a*self.outer_clip_cut_off, name="outer_clip_max" )
+        if self.outer_clip:
+            # to avoid very numerical errors due to very
+            # large pre-clip actions, we cap pre-clip values
+            # hard at 10 times the bounds.
+            # This can happen if an action has no effect
+            # on the gains process (e.g. hedge == 0)
+            if lbnd_outer is None or ubnd_outer is None:
+                lbnd_outer, ubnd_outer = self.outer_bounds( lbnd_a, ubnd_a )
+            actions = tf.clip_by_value( actions, lbnd_outer, ubnd_outer, name="outer_clip" )
 
-            dbnd = ubnd_a - lbnd_a
+        dbnd = ubnd_a - lbnd_a
+        if self.check_numerics:
             actions  = tf.debugging.check_numerics(actions, "Numerical actions error before clipping action in %s. Turn on tf.enable_check_numerics to find the root cause. See softclip.py" % __file__ )
-            rel  = ( actions - lbnd_a ) / dbnd
-            act  = tf.debugging.check_numerics(rel, "Numerical error before clipping action in %s. Turn on tf.enable_check_numerics to find the root cause. See softclip.py" % __file__ )
-            rel  = self.softclip( rel )
-            act  = tf.where( dbnd > 0., rel *  dbnd + lbnd_a, 0., name="soft_clipped_act" )
+        rel  = ( actions - lbnd_a ) / dbnd
+        if self.check_numerics:
+            rel  = tf.debugging.check_numerics(rel, "Numerical error before clipping action in %s. Turn on tf.enable_check_numerics to find the root cause. See softclip.py" % __file__ )
+        # note that the soft clip is not the identity inside [0,1], hence it
+        # cannot be skipped for actions which are already within their bounds.
+        # Use 'hard_clip' to avoid its cost.
+        rel  = self.softclip( rel )
+        act  = tf.where( dbnd > 0., rel *  dbnd + lbnd_a, 0., name="soft_clipped_act" )
+        if self.check_numerics:
             act  = tf.debugging.check_numerics(act, "Numerical error clipping action in %s. Turn on tf.enable_check_numerics to find the root cause. See softclip.py" % __file__ )
-            return act
+        return act
@@ -184,6 +184,7 @@ class Monitor(tf.keras.callbacks.Callback):
         optimizer_id          = uniqueHash( tf.keras.optimizers.serialize( gym.optimizer ) )
         self.cache_file       = uniqueFileName48( gym.unique_id, optimizer_id, world.unique_id, val_world.unique_id ) if cache_file_name is None else cache_file_name
         self.full_cache_file  = self.cache_dir.fullKeyName( self.cache_file )
+        self.cache_checkpoint = os.path.splitext( self.full_cache_file )[0] + ".ckpt"  # prefix of the gym's tf.train.Checkpoint, next to the cache file
 
         if not self.cache_mode.is_off:
             if self.print_text: print("Caching enabled @ '%s'" %  self.full_cache_file)
@@ -299,7 +300,7 @@ class Monitor(tf.keras.callbacks.Callback):
     
     def write_cache(self):
         """ Write cache to disk """
-        cache = { 'gym':           self.gym.create_cache(),
+        cache = { 'gym':           self.gym.create_cache( self.cache_checkpoint ),
                   'progress_data': self.progress_data
                 }            
         self.cache_dir.write( self.cache_file, cache )